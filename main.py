@@ -2,13 +2,13 @@
 Programming practice tool
 """
 import ast
-import numpy as np
 import random
 import string
 import os
-import rlcompleter
-import readline
 import itertools
+import threading
+import queue
+import functools
 
 
 def load_corpus(d):
@@ -24,14 +24,21 @@ def load_corpus(d):
     -------
     corpus : dict
         Dict mapping expression type to a list of expression templates.
+        Blank lines and lines starting with # are skipped.
     """
     corpus = dict()
-    for fname in os.listdir(d):
-        if fname.endswith('~'):
-            continue
-        f = open(os.path.join(d, fname))
-        lines = [x.strip() for x in f.readlines()]
-        corpus[fname] = lines
+    with os.scandir(d) as entries:
+        for entry in entries:
+            if entry.name.endswith('~') or not entry.is_file():
+                continue
+            with open(entry.path, encoding='utf-8') as f:
+                lines = [x.strip() for x in f.read().splitlines()]
+            lines = [x for x in lines if x and not x.startswith('#')]
+            corpus[entry.name] = lines
+            # parse each template once up front rather than on every
+            # instantiation
+            for line in lines:
+                _PARSED[line] = _parse(line)
     return corpus
 
 
@@ -49,12 +56,22 @@ def safe_eval(s):
         Either the value of the expression, or the exception that was
         raised when trying to evaluate the expression.
     """
+    # pure literals (the usual shape of an answer) don't need a code
+    # object, so try the cheaper literal_eval on the cached AST first;
+    # anything it rejects, including ASTs nested too deeply for its
+    # recursive walk, goes through eval() to get the real value or
+    # error
+    try:
+        return ast.literal_eval(safe_compile(s))
+    except (ValueError, TypeError, MemoryError, RecursionError):
+        pass
     try:
         return eval(s)
     except Exception as e:
         return e
 
 
+@functools.lru_cache(maxsize=4096)
 def safe_compile(s):
     """Compile a string to an abstract syntax tree, catching
     exceptions.
@@ -69,6 +86,10 @@ def safe_compile(s):
     val : ast.Expression
         Either the AST of the expression, or the AST of the exception
         that was raised when trying to evaluate the expression.
+
+    Notes
+    -----
+    Results are cached, so callers must not modify the returned AST.
     """
     try:
         x = compile(s, 'NO FILE', 'eval', ast.PyCF_ONLY_AST)
@@ -78,6 +99,162 @@ def safe_compile(s):
                        ast.PyCF_ONLY_AST)
 
 
+def _is_num(node):
+    """Return whether an AST node is a number literal. Negative numbers
+    count too, even though they parse as a negated positive number."""
+    if isinstance(node, ast.UnaryOp) and isinstance(node.op, ast.USub):
+        node = node.operand
+    return (isinstance(node, ast.Constant) and
+            isinstance(node.value, (int, float, complex)) and
+            not isinstance(node.value, bool))
+
+
+def _is_str(node):
+    """Return whether an AST node is a string literal."""
+    return isinstance(node, ast.Constant) and isinstance(node.value, str)
+
+
+# shared Formatter, used only for its parse() method
+_FORMATTER = string.Formatter()
+
+# expansion plans for every corpus template, filled in by load_corpus()
+_PARSED = dict()
+
+
+def _escape_braces(s):
+    """Escape { and } in literal text as {{ and }}.
+
+    Parameters
+    ----------
+    s : string
+        Literal text to escape.
+
+    Returns
+    -------
+    escaped : string
+        The text with every brace doubled.
+    """
+    # most literal text has no braces at all
+    if '{' not in s and '}' not in s:
+        return s
+    return s.replace('{', '{{').replace('}', '}}')
+
+
+def _parse(expr):
+    """Split an expression template into Formatter tokens and work out
+    how it needs to be expanded.
+
+    Parameters
+    ----------
+    expr : string
+        Expression template to parse.
+
+    Returns
+    -------
+    tokens : tuple
+        Tuple of (literal, var, fmt, conv) tuples as produced by
+        string.Formatter.parse(), except that { and } in the literal
+        text are escaped again as {{ and }}.
+    complete : bool
+        Whether the template has no placeholders left to fill in.
+    binds : bool
+        Whether any placeholder binds a variable.
+    """
+    try:
+        return _PARSED[expr]
+    except KeyError:
+        pass
+    tokens = tuple((_escape_braces(s), var, fmt, conv)
+                   for s, var, fmt, conv in _FORMATTER.parse(expr))
+    assert all(tok[3] is None for tok in tokens)
+    complete = all(tok[1] is None for tok in tokens)
+    binds = any(tok[2] for tok in tokens)
+    return tokens, complete, binds
+
+
+def _substitute(tokens, corpus):
+    """Fill in one level of placeholders in an expression template
+    that doesn't bind any variables.
+
+    Parameters
+    ----------
+    tokens : tuple
+        Tokens of the expression template to fill in, as returned
+        by _parse().
+    corpus : dict
+        Corpus in the formate returned by load_corpus().
+
+    Returns
+    -------
+    next_expr : string
+        The expression with each placeholder replaced by a random
+        corpus template.
+    """
+    choice = random.choice
+    parts = []
+    append = parts.append
+    for s, var, fmt, conv in tokens:
+        append(s)
+        if var is not None:
+            append(choice(corpus[var]))
+    return ''.join(parts)
+
+
+def _fill_placeholders(tokens, corpus):
+    """Fill in one level of placeholders in an expression template.
+
+    Parameters
+    ----------
+    tokens : tuple
+        Tokens of the expression template to fill in, as returned
+        by _parse().
+    corpus : dict
+        Corpus in the formate returned by load_corpus().
+
+    Returns
+    -------
+    next_expr : string or None
+        The expression with each placeholder replaced by a random
+        corpus template, or None if a variable couldn't be bound and
+        the instantiation should be rerolled.
+    """
+    # local names are cheaper to look up than globals in the loop below
+    choice = random.choice
+    parse = _parse
+
+    parts = []
+    append = parts.append
+    for s, var, fmt, conv in tokens:
+        # literal text comes back from _parse() already escaped
+        append(s)
+
+        # if there is something that needs to be filled in
+        if var is not None:
+
+            # if there's a non-empty fmt string then we're binding a
+            # variable
+            if fmt:
+                variable_expr = choice(corpus[var])
+                variable_type, variable_name = fmt.split(':')
+                # the bound template goes straight into parts, which
+                # is thrown away anyway if we abort
+                for s2, var2, fmt2, conv2 in parse(variable_expr)[0]:
+                    append(s2)
+                    if var2 is not None:
+                        if var2 != variable_type:
+                            # weird case, abort and reroll
+                            return None
+                        else:
+                            append(variable_name)
+
+            # we're not binding a variable, so just append a random
+            # corpus template of the right type
+            else:
+                append(choice(corpus[var]))
+
+    return ''.join(parts)
+
+
 def instantiate(expr, corpus):
     """Instantiate an expression template from the corpus.
 
@@ -98,47 +275,31 @@ def instantiate(expr, corpus):
     # try again
     original_expr = expr
 
-    f = string.Formatter()
-
-    # repeat while the expression isn't fully instantiated
+    # reroll until we get all the way through without aborting
     while True:
-        next_expr = ''
-        for s, var, fmt, conv in f.parse(expr):
-            assert conv is None
-            # replace { with double {{ and } with double }}
-            next_expr += s.replace('{', '{{').replace('}', '}}')
-
-            # if there is something that needs to be filled in
-            if var is not None:
-
-                # if there's a non-empty fmt string then we're binding
-                # a variable
-                if fmt:
-                    bound_expr = ''
-                    variable_expr = random.choice(corpus[var])
-                    variable_type, variable_name = fmt.split(':')
-                    for s2, var2, fmt2, conv2 in f.parse(variable_expr):
-                        # replace { with double {{ and } with double }}
-                        bound_expr += s2.replace('{', '{{').replace('}', '}}')
-                        assert conv2 is None
-                        if var2 is not None:
-                            if var2 != variable_type:
-                                # weird case, abort and reroll
-                                return instantiate(original_expr, corpus)
-                            else:
-                                bound_expr += variable_name
-                    next_expr += bound_expr
-
-                # we're not binding a variable, so just append a
-                # random corpus template of the right type
-                else:
-                    next_expr += random.choice(corpus[var])
-
-        expr = next_expr
-
-        # check if we're done instantiating the template
-        stuff = list(f.parse(expr))
-        if all(x[1] is None for x in stuff):
+        tokens, complete, binds = _parse(original_expr)
+
+        # repeat while the expression isn't fully instantiated
+        while True:
+            if binds:
+                expr = _fill_placeholders(tokens, corpus)
+
+                # check if we aborted
+                if expr is None:
+                    break
+
+            # without any variables to bind this round can't abort,
+            # so take the plain substitution path
+            else:
+                expr = _substitute(tokens, corpus)
+
+            # check if we're done instantiating the template, keeping
+            # the tokens for the next round if we're not
+            tokens, complete, binds = _parse(expr)
+            if complete:
+                break
+
+        if expr is not None:
             break
 
     # replace double {{ with { and double }} with }
@@ -151,10 +312,25 @@ class Problem(object):
     pass
 
 
-class SingletonForwardProblem(Problem):
-    """Abstract base class for problems whose answer should be a
-    single value of a given type"""
-    _type = None
+class _SimplifiedChecker(Problem):
+    """Abstract base class for problems whose answer should evaluate to
+    the right value and be written in its simplest form"""
+    _node_type = None
+
+    def _is_correct(self, value):
+        """Return whether an evaluated answer is the expected value."""
+        return value == self.answer
+
+    def _check_elements(self, body):
+        """Return whether the parts of an answer's AST are simplified."""
+        return True
+
+    def _is_simplified(self, answer):
+        """Return whether an answer is written in its simplest form."""
+        assert self._node_type is not None
+        body = safe_compile(answer).body
+        return (isinstance(body, self._node_type) and
+                self._check_elements(body))
 
     def check_answer(self, answer):
         """Check a user-provided answer.
@@ -171,184 +347,102 @@ class SingletonForwardProblem(Problem):
         msg : string
             Message to print.
         """
-        if safe_eval(answer) == self.answer:
-            x = safe_compile(answer)
-            assert self._type is not None
-            if isinstance(x.body, self._type):
-                return True, 'Correct!'
-            else:
-                return False, 'Correct, but not fully simplified'
-        else:
+        if not self._is_correct(safe_eval(answer)):
             return False, 'Incorrect :('
+        if self._is_simplified(answer):
+            return True, 'Correct!'
+        return False, 'Correct, but not fully simplified'
 
 
-class BoolForwardProblem(Problem):
+class SingletonForwardProblem(_SimplifiedChecker):
     """Abstract base class for problems whose answer should be a
-    single bool"""
-    def check_answer(self, answer):
-        """Check a user-provided answer.
-        
-        Parameters
-        ----------
-        answer : string
-            The answer to be checked.
+    single value of a given type"""
+    _literal_check = None
 
-        Returns
-        -------
-        passed : bool
-            Whether the user successfully passed the test.
-        msg : string
-            Message to print.
-        """
-        if safe_eval(answer) == self.answer:
-            x = safe_compile(answer)
-            if isinstance(x.body, ast.Name) and x.body.id in ['True', 'False']:
-                return True, 'Correct!'
-            else:
-                return False, 'Correct, but not fully simplified'
-        else:
-            return False, 'Incorrect :('
+    def _is_simplified(self, answer):
+        assert self._literal_check is not None
+        return self._literal_check(safe_compile(answer).body)
 
 
-class ListOfSameForwardProblem(Problem):
-    """Abstract base class for problems whose answer should be a list of
-    elements of the same type"""
-    _element_type = None
+class BoolForwardProblem(_SimplifiedChecker):
+    """Abstract base class for problems whose answer should be a
+    single bool"""
 
-    def check_answer(self, answer):
-        """Check a user-provided answer.
-        
-        Parameters
-        ----------
-        answer : string
-            The answer to be checked.
+    def _is_simplified(self, answer):
+        # a bare True or False is the only simplified form, so there's
+        # no need to look at the AST
+        return answer.strip() in ('True', 'False')
 
-        Returns
-        -------
-        passed : bool
-            Whether the user successfully passed the test.
-        msg : string
-            Message to print.
-        """
-        if safe_eval(answer) == self.answer:
-            x = safe_compile(answer)
-            if isinstance(x.body, ast.List):
-                y = x.body
-                assert self._element_type is not None
-                for z in y.elts:
-                    if not isinstance(z, self._element_type):
-                        return False, 'Correct, but not fully simplified'
-                return True, 'Correct!'
-            else:
-                return False, 'Correct, but not fully simplified'
-        else:
-            return False, 'Incorrect :('
 
+class CollectionOfSameForwardProblem(_SimplifiedChecker):
+    """Abstract base class for problems whose answer should be a
+    collection of elements of the same type"""
+    _element_check = None
+
+    def _check_elements(self, body):
+        ec = self._element_check
+        assert ec is not None
+        return all(ec(z) for z in body.elts)
 
-class SetOfSameForwardProblem(Problem):
-    """Abstract base class for problems whose answer should be a set of
+
+class ListOfSameForwardProblem(CollectionOfSameForwardProblem):
+    """Abstract base class for problems whose answer should be a list of
     elements of the same type"""
-    _element_type = None
+    _node_type = ast.List
 
-    def check_answer(self, answer):
-        """Check a user-provided answer.
-        
-        Parameters
-        ----------
-        answer : string
-            The answer to be checked.
 
-        Returns
-        -------
-        passed : bool
-            Whether the user successfully passed the test.
-        msg : string
-            Message to print.
-        """
-        if safe_eval(answer) == self.answer:
-            x = safe_compile(answer)
-            if isinstance(x.body, ast.Set):
-                y = x.body
-                assert self._element_type is not None
-                for z in y.elts:
-                    if not isinstance(z, self._element_type):
-                        return False, 'Correct, but not fully simplified'
-                return True, 'Correct!'
-            else:
-                return False, 'Correct, but not fully simplified'
-        else:
-            return False, 'Incorrect :('
+class SetOfSameForwardProblem(CollectionOfSameForwardProblem):
+    """Abstract base class for problems whose answer should be a set of
+    elements of the same type"""
+    _node_type = ast.Set
 
 
-class DictOfSameSameForwardProblem(Problem):
+class DictOfSameSameForwardProblem(_SimplifiedChecker):
     """Abstract base class for problems whose answer should be a dict
     mapping elements of one type to elements of another type"""
-    _key_type = None
-    _value_type = None
+    _node_type = ast.Dict
+    _key_check = None
+    _value_check = None
 
-    def check_answer(self, answer):
-        """Check a user-provided answer.
-        
-        Parameters
-        ----------
-        answer : string
-            The answer to be checked.
+    def _is_correct(self, value):
+        return isinstance(value, dict) and value == self.answer
 
-        Returns
-        -------
-        passed : bool
-            Whether the user successfully passed the test.
-        msg : string
-            Message to print.
-        """
-        eval_answer = safe_eval(answer)
-        if (isinstance(eval_answer, dict) and eval_answer == self.answer):
-            x = safe_compile(answer)
-            if isinstance(x.body, ast.Dict):
-                y = x.body
-                assert self._key_type is not None
-                assert self._value_type is not None
-                for z in y.keys:
-                    if not isinstance(z, self._key_type):
-                        return False, 'Correct, but not fully simplified'
-                for z in y.values:
-                    if not isinstance(z, self._value_type):
-                        return False, 'Correct, but not fully simplified'
-                return True, 'Correct!'
-            else:
-                return False, 'Correct, but not fully simplified'
-        else:
-            return False, 'Incorrect :('
+    def _check_elements(self, body):
+        kc, vc = self._key_check, self._value_check
+        assert kc is not None
+        assert vc is not None
+        return (all(kc(z) for z in body.keys) and
+                all(vc(z) for z in body.values))
 
 
 class NumForwardProblem(SingletonForwardProblem):
     """Abstract base class for problems whose answer should be a
     number"""
-    _type = ast.Num
+    _literal_check = staticmethod(_is_num)
 
 
 class StringForwardProblem(SingletonForwardProblem):
     """Abstract base class for problems whose answer should be a
     string"""
-    _type = ast.Str
+    _literal_check = staticmethod(_is_str)
 
 
 class ListOfNumForwardProblem(ListOfSameForwardProblem):
     """Abstract base class for problems whose answer should be a list
     of numbers"""
-    _element_type = ast.Num
+    _element_check = staticmethod(_is_num)
 
 
 class ListOfStringForwardProblem(ListOfSameForwardProblem):
     """Abstract base class for problems whose answer should be a list
     of strings"""
-    _element_type = ast.Str
+    _element_check = staticmethod(_is_str)
 
 
 class SetOfNumForwardProblem(SetOfSameForwardProblem):
     """Abstract base class for problems whose answer should be a list
     of strings"""
-    _element_type = ast.Num
+    _element_check = staticmethod(_is_num)
 
 
 class CorpusProblem(Problem):
@@ -425,8 +519,8 @@ Correct, but you are cheating by using a list inside the list comprehension
 class AdditionProblem(NumForwardProblem):
     """Problem which requires you to add two numbers"""
     def __init__(self):
-        self.a = np.random.randint(10)
-        self.b = np.random.randint(10)
+        self.a = random.randrange(10)
+        self.b = random.randrange(10)
         self.answer = self.a + self.b
 
     def prompt(self):
@@ -482,8 +576,8 @@ class DictOfStringNumCorpusProblem(CorpusProblem,
     mapping strings to nums from the corpus"""
     _seed_type = ['dict_comprehension_of_string_num',
                   'dict_expr_of_string_num']
-    _key_type = ast.Str
-    _value_type = ast.Num
+    _key_check = staticmethod(_is_str)
+    _value_check = staticmethod(_is_num)
 
 
 class ListComprehensionBackwardCorpusProblem(ListComprehensionBackwardProblem,
@@ -493,6 +587,19 @@ class ListComprehensionBackwardCorpusProblem(ListComprehensionBackwardProblem,
     _seed_type = 'list_comprehension_of_num'
 
 
+# problem classes that get_problem() picks from
+_PROBLEM_CLASSES = (
+    SetOfNumCorpusProblem,
+    BoolCorpusProblem,
+    DictOfStringNumCorpusProblem,
+    ListOfNumCorpusProblem,
+    ListOfStringCorpusProblem,
+    StringCorpusProblem,
+    NumCorpusProblem,
+    ListComprehensionBackwardCorpusProblem,
+    )
+
+
 def get_problem():
     """Return a random problem instance.
 
@@ -500,39 +607,68 @@ def get_problem():
     -------
     prob : Problem
     """
-    cls = random.choice([
-            SetOfNumCorpusProblem,
-            BoolCorpusProblem,
-            DictOfStringNumCorpusProblem,
-            ListOfNumCorpusProblem,
-            ListOfStringCorpusProblem,
-            StringCorpusProblem,
-            NumCorpusProblem,
-            ListComprehensionBackwardCorpusProblem,
-            ])
+    cls = random.choice(_PROBLEM_CLASSES)
     return cls()
 
 
+# problems generated ahead of time by the prefill thread, so the user
+# doesn't wait for instantiation after answering
+_PROBLEM_QUEUE = queue.Queue(maxsize=8)
+
+
+def _prefill():
+    """Keep the problem queue topped up, forever"""
+    while True:
+        try:
+            prob = get_problem()
+        except Exception as e:
+            # hand the error over to the main thread rather than
+            # leaving it waiting on an empty queue
+            prob = e
+        _PROBLEM_QUEUE.put(prob)
+
+
+def start_prefill():
+    """Start generating problems in a background thread. The corpus
+    must already be loaded."""
+    t = threading.Thread(target=_prefill)
+    t.daemon = True
+    t.start()
+
+
+def next_problem():
+    """Return the next pre-generated problem.
+
+    Returns
+    -------
+    prob : Problem
+    """
+    prob = _PROBLEM_QUEUE.get()
+    if isinstance(prob, Exception):
+        raise prob
+    return prob
+
+
 def explore_loop():
     """Read-Eval-Print Loop for exploration mode"""
     while True:
         try:
-            answer = raw_input('>exp>')
+            answer = input('>exp>')
         except EOFError:
             return
 
         if answer == 'q' or answer == 'quit':
             return
 
-        print repr(safe_eval(answer))
+        print(repr(safe_eval(answer)))
 
 
 def generate_loop():
     """Mode that generates examples until user hits Ctrl-C"""
     try:
         while True:
-            prob = get_problem()
-            print prob.prompt()
+            prob = next_problem()
+            print(prob.prompt())
     except KeyboardInterrupt:
         return
 
@@ -540,17 +676,17 @@ def generate_loop():
 def main_loop():
     """Main loop of the program"""
 
-    # generate the first problem
-    prob = get_problem()
+    # get the first problem
+    prob = next_problem()
 
     # track number of correct answers
     ncorrect = 0
 
     while True:
-        print
-        print prob.prompt()
+        print()
+        print(prob.prompt())
         try:
-            answer = raw_input('>>>')
+            answer = input('>>>')
         except EOFError:
             break
 
@@ -566,37 +702,49 @@ def main_loop():
 
         # skip this problem
         if answer == 's' or answer == 'skip':
-            prob = get_problem()
+            prob = next_problem()
             continue
 
         # check the answer
         passed, msg = prob.check_answer(answer)
-        # print repr(safe_eval(answer))
-        print msg
+        # print(repr(safe_eval(answer)))
+        print(msg)
         if passed:
             ncorrect += 1
-            print 'Got %d correct' % ncorrect
-            prob = get_problem()
+            print('Got %d correct' % ncorrect)
+            prob = next_problem()
 
-    print
-    print 'Goodbye! :)'
-    print 'You answered %d problems' % ncorrect
+    print()
+    print('Goodbye! :)')
+    print('You answered %d problems' % ncorrect)
 
 
 if __name__ == '__main__':
     # initialize readline to get nice editing, tab-completion and
-    # history
-    readline.read_init_file('.readline')
+    # history; only needed when running interactively, so it's
+    # imported here rather than at the top
+    import readline
+    import rlcompleter
+    try:
+        readline.read_init_file('.readline')
+    except FileNotFoundError:
+        pass
     try:
         readline.read_history_file('.history')
-    except IOError:
+    except OSError:
         pass
 
     # load corpora
     corpus = load_corpus('corpus')
 
+    # start generating problems in the background
+    start_prefill()
+
     # main loop
     main_loop()
 
     # save history
-    readline.write_history_file('.history')
+    try:
+        readline.write_history_file('.history')
+    except OSError:
+        pass